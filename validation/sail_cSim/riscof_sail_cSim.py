@@ -1,5 +1,9 @@
+import collections
+import functools
+import io
 import logging
 import os
+import re
 import shutil
 
 import riscof.utils as utils
@@ -8,23 +12,90 @@ from riscof.pluginTemplate import pluginTemplate
 logger = logging.getLogger()
 
 
+@functools.lru_cache(maxsize=None)
+def _which(name):
+    return shutil.which(name)
+
+
+# Translate the 'jobs' config value into a make flag. 'auto' runs one job per
+# CPU, 'max' does not limit the number of jobs and any number is capped at
+# eight jobs per CPU so a typo cannot fork-bomb the host.
+def _jobs_flag(jobs):
+    ncpu = os.cpu_count() or 1
+    jobs = str(jobs).strip().lower()
+    if jobs == 'auto':
+        return '-j' + str(ncpu)
+    if jobs == 'max':
+        return '-j'
+    try:
+        return '-j' + str(max(1, min(int(jobs), 8 * ncpu)))
+    except ValueError:
+        logger.error("Invalid jobs value '" + jobs + "', expected a number, 'auto' or 'max'.")
+        raise SystemExit(1)
+
+
+_TestPaths = collections.namedtuple('_TestPaths', ['obj', 'dep', 'elf', 'disas', 'sig', 'rsp'])
+
+
+# riscof hands out POSIX work directories, so plain concatenation is enough
+def _paths(test_dir, name):
+    obj = test_dir + '/ref.o'
+    return _TestPaths(obj, obj + '.d', test_dir + '/ref.elf', test_dir + '/ref.disass',
+                      test_dir + '/' + name + '.signature', test_dir + '/defs.rsp')
+
+
+# Leave the file, and with it its timestamp, alone if it already has the wanted content
+def _write_if_changed(path, text):
+    if os.path.exists(path):
+        with open(path) as current:
+            if current.read() == text:
+                return
+    with open(path, "w") as new:
+        new.write(text)
+
+
+def _filetarget(command, output, input):
+    return "\n\n" + output + " : " + input + " \n\t" + command.replace("\n", "\n\t")
+
+
 class makeUtil(utils.makeUtil):
-    def add_filetarget(self, command, output, input):
-        with open(self.makefilePath, "a") as makefile:
-            makefile.write("\n\n" + output + " : " + input + " \n\t" + command.replace("\n", "\n\t"))
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Targets are collected in memory and written out in one go by flush()
+        self._buf = io.StringIO()
+        self._head = ""
+
+    def add_block(self, text):
+        self._buf.write(text)
 
-    def add_phonytarget(self, input, tname=""):
-        if tname == "":
-            tname = "TARGET" + str(len(self.targets))
-        with open(self.makefilePath, "a") as makefile:
-            makefile.write("\n\n.PHONY : " + tname + "\n" + tname + " : " + input + "\n")
-            self.targets.append(tname)
+    def add_include(self, paths):
+        # Optional include, so missing files (e.g. before the first build) are not an error
+        self._buf.write("\n\n-include " + " ".join(paths) + "\n")
+
+    def add_final_target(self, deps, tname="all"):
+        # Written ahead of all other rules by flush(), which also makes it the default goal
+        self._head = ".PHONY : " + tname + "\n" + tname + " : " + " ".join(deps) + "\n"
+        self.targets.append(tname)
+
+    def flush(self):
+        with open(self.makefilePath, "w") as makefile:
+            makefile.write(self._head + self._buf.getvalue())
 
 
 class sail_cSim(pluginTemplate):
     __model__ = "sail_c_simulator"
     __version__ = "0.5.0"
 
+    # ISA extensions in the order their suffixes are appended to self.isa
+    _EXT_TABLE = (
+        ("G", "IMAFDZicsr_Zifencei"),
+        ("I", "i"),
+        ("M", "m"),
+        ("C", "c"),
+        ("F", "f"),
+        ("D", "d"),
+    )
+
     def __init__(self, *args, **kwargs):
         sclass = super().__init__(*args, **kwargs)
 
@@ -32,11 +103,16 @@ class sail_cSim(pluginTemplate):
         if config is None:
             logger.error("Config node for sail_cSim missing.")
             raise SystemExit(1)
-        self.num_jobs = str(config['jobs'] if 'jobs' in config else 1)
+        self.num_jobs_flag = _jobs_flag(config['jobs'] if 'jobs' in config else 1)
         if 'target_run' in config and config['target_run'] == '0':
             self.target_run = False
         else:
             self.target_run = True
+        # The disassembly is only a debugging aid and can be skipped with disass=0
+        if 'disass' in config and config['disass'] == '0':
+            self.disass = False
+        else:
+            self.disass = True
         self.pluginpath = os.path.abspath(config['pluginpath'])
         self.sail_exe = {'32': os.path.join(config['PATH'] if 'PATH' in config else "", "riscv_sim_RV32"),
                          '64': os.path.join(config['PATH'] if 'PATH' in config else "", "riscv_sim_RV64")}
@@ -51,91 +127,124 @@ class sail_cSim(pluginTemplate):
     def initialise(self, suite, work_dir, archtest_env):
         self.suite = suite
         self.work_dir = work_dir
-        self.objdump_cmd = 'riscv{1}-unknown-linux-gnu-objdump -D {0} > {2};'
-        self.compile_cmd = 'riscv{1}-unknown-linux-gnu-gcc -march={0} \
-         -static -mcmodel=medany -fvisibility=hidden -nostdlib -nostartfiles\
-         -T ' + self.pluginpath + '/env/link.ld\
+        self.objdump_cmd = 'riscv{1}-unknown-linux-gnu-objdump -d {0} > {2};'
+        # Tests are compiled to an object file first and linked separately, so ccache (which does
+        # not cache link invocations) can serve the compile step
+        self.compile_cmd = 'riscv{1}-unknown-linux-gnu-gcc -c -march={0} \
+         -mcmodel=medany -fvisibility=hidden\
          -I ' + self.pluginpath + '/env/\
-         -I ' + archtest_env
+         -I ' + archtest_env + '\
+         -MMD -MP -MF {2}'
+        if _which('ccache') is not None:
+            self.compile_cmd = 'ccache ' + self.compile_cmd
+        self.link_cmd = 'riscv{1}-unknown-linux-gnu-gcc -march={0} \
+         -static -nostdlib -nostartfiles\
+         -T ' + self.pluginpath + '/env/link.ld'
 
     def build(self, isa_yaml, platform_yaml):
         ispec = utils.load_yaml(isa_yaml)['hart0']
         self.xlen = ('64' if 64 in ispec['supported_xlen'] else '32')
-        self.isa = 'rv' + self.xlen
-        self.compile_cmd = self.compile_cmd + ' -mabi=' + ('lp64 ' if 64 in ispec['supported_xlen'] else 'ilp32 ')
-        if "G" in ispec["ISA"]:
-            self.isa += "IMAFDZicsr_Zifencei"
-        if "I" in ispec["ISA"]:
-            self.isa += 'i'
-        if "M" in ispec["ISA"]:
-            self.isa += 'm'
-        if "C" in ispec["ISA"]:
-            self.isa += 'c'
-        if "F" in ispec["ISA"]:
-            self.isa += 'f'
-        if "D" in ispec["ISA"]:
-            self.isa += 'd'
+        mabi = ' -mabi=' + ('lp64 ' if 64 in ispec['supported_xlen'] else 'ilp32 ')
+        self.compile_cmd = self.compile_cmd + mabi
+        self.link_cmd = self.link_cmd + mabi
+        # xlen is fixed from here on, substitute it now and renumber the remaining per-test fields
+        self.compile_cmd = self.compile_cmd.format('{0}', self.xlen, '{1}')
+        self.link_cmd = self.link_cmd.format('{0}', self.xlen)
+        self.objdump_cmd = self.objdump_cmd.format('{0}', self.xlen, '{1}')
+        # Split e.g. RV64IMCZicsr_Zifencei into single-letter and Z extensions
+        isa_tokens = set(re.findall(r'Z[a-z]+|[A-Z]', ispec["ISA"]))
+        self.isa = ''.join(['rv', self.xlen] + [suffix for ext, suffix in self._EXT_TABLE if ext in isa_tokens])
         objdump = "riscv{0}-unknown-elf-objdump".format(self.xlen)
-        if shutil.which(objdump) is None:
+        if _which(objdump) is None:
             logger.error(objdump + ": executable not found. Please check environment setup.")
             # raise SystemExit(1)
         compiler = "riscv{0}-unknown-elf-gcc".format(self.xlen)
-        if shutil.which(compiler) is None:
+        if _which(compiler) is None:
             logger.error(compiler + ": executable not found. Please check environment setup.")
             # raise SystemExit(1)
-        if shutil.which(self.sail_exe[self.xlen]) is None:
+        if _which(self.sail_exe[self.xlen]) is None:
             logger.error(self.sail_exe[self.xlen] + ": executable not found. Please check environment setup.")
             # raise SystemExit(1)
-        if shutil.which(self.make) is None:
+        if _which(self.make) is None:
             logger.error(self.make + ": executable not found. Please check environment setup.")
             # raise SystemExit(1)
 
-    def runTests(self, testList, cgf_file=None):
-        if os.path.exists(self.work_dir + "/Makefile." + self.name[:-1]):
-            os.remove(self.work_dir + "/Makefile." + self.name[:-1])
-        make = makeUtil(makefilePath=os.path.join(self.work_dir, "Makefile." + self.name[:-1]))
-        make.makeCommand = self.make + ' -j' + self.num_jobs
+    # Render the Makefile rules of a single test. Only reads plugin state, so it can be
+    # called for any test independently of the others
+    def _render_test(self, testentry, name, cgf_file=None):
+        test = testentry['test_path']
+        test_dir = testentry['work_dir']
+        test_name = os.path.basename(test)[:-2]
+        log_file = test_dir + '/' + test_name + '.log'
+
+        obj_file, dep_file, elf_file, disas_file, sig_file, rsp_file = _paths(test_dir, name)
+
+        isa = testentry['isa'].lower()
+        compile_cmd = ' '.join([self.compile_cmd.format(isa, dep_file), test, '-o', obj_file, '@' + rsp_file])
+        link_cmd = ' '.join([self.link_cmd.format(isa), obj_file, '-o', elf_file])
+
+        sim_cmd = self.sail_exe[self.xlen] + ' --test-signature={0} {1} > {2} 2>&1;'.format(sig_file, elf_file,
+                                                                                            log_file)
+        cov_str = ' '
+        for label in testentry['coverage_labels']:
+            cov_str += ' -l ' + label
+
+        if cgf_file is not None:
+            coverage_file = test_dir + '/coverage.rpt'
+            coverage_cmd = 'riscv_isac --verbose info coverage -d \
+                    -t {0} --parser-name c_sail -o {5}  \
+                    --sig-label begin_signature  end_signature \
+                    --test-label rvtest_code_begin rvtest_code_end \
+                    -e {4} -c {1} -x{2} {3};'.format(log_file, ' -c '.join(cgf_file), self.xlen, cov_str, elf_file, coverage_file)
+        else:
+            coverage_cmd = ''
+
+        rules = [_filetarget(compile_cmd, obj_file, test + ' ' + rsp_file),
+                 _filetarget(link_cmd, elf_file, obj_file)]
+        if self.target_run and self.disass:
+            disas_cmd = self.objdump_cmd.format(elf_file, disas_file)
+            rules.append(_filetarget(disas_cmd, disas_file, elf_file))
+        rules.append(_filetarget(sim_cmd, sig_file, elf_file))
+        if len(coverage_cmd) > 0:
+            # The log is written by the simulation rule alongside the signature
+            rules.append(_filetarget(coverage_cmd, coverage_file, sig_file + ' ' + elf_file))
+
+        goals = []
+        if self.target_run:
+            goals.append(sig_file)
+            if len(coverage_cmd) > 0:
+                goals.append(coverage_file)
+            if self.disass:
+                goals.append(disas_file)
+        else:
+            goals.append(elf_file)
+        return ''.join(rules), goals, dep_file
+
+    # The macros are handed to gcc in response files, which make can track like any other input
+    def _write_rsp_files(self, testList, name):
         for file in testList:
             testentry = testList[file]
-            test = testentry['test_path']
-            test_dir = testentry['work_dir']
-            test_name = test.rsplit('/', 1)[1][:-2]
-            log_file = os.path.join(test_dir, test_name + '.log')
-
-            elf_file = os.path.join(test_dir, 'ref.elf')
-            disas_file = os.path.join(test_dir, 'ref.disass')
-
-            cmd = self.compile_cmd.format(testentry['isa'].lower(), self.xlen) + ' ' + test + ' -o ' + elf_file
-            compile_cmd = cmd + ' -D' + " -D".join(testentry['macros'])
-
-            disas_cmd = self.objdump_cmd.format(elf_file, self.xlen, disas_file)
-            sig_file = os.path.join(test_dir, self.name[:-1] + ".signature")
-
-            sim_cmd = self.sail_exe[self.xlen] + ' --test-signature={0} {1} > {2} 2>&1;'.format(sig_file, elf_file,
-                                                                                                log_file)
-            cov_str = ' '
-            for label in testentry['coverage_labels']:
-                cov_str += ' -l ' + label
-
-            if cgf_file is not None:
-                coverage_file = os.path.join(test_dir, 'coverage.rpt')
-                coverage_cmd = 'riscv_isac --verbose info coverage -d \
-                        -t {0} --parser-name c_sail -o {5}  \
-                        --sig-label begin_signature  end_signature \
-                        --test-label rvtest_code_begin rvtest_code_end \
-                        -e {4} -c {1} -x{2} {3};'.format(log_file, ' -c '.join(cgf_file), self.xlen, cov_str, elf_file, coverage_file)
-            else:
-                coverage_cmd = ''
-
-            make.add_filetarget(compile_cmd, elf_file, test)
-            make.add_filetarget(disas_cmd, disas_file, elf_file)
-            make.add_filetarget(sim_cmd, sig_file, elf_file)
-            if len(coverage_cmd) > 0:
-                make.add_filetarget(coverage_cmd, sig_file, test)
+            rsp_file = _paths(testentry['work_dir'], name).rsp
+            _write_if_changed(rsp_file, ''.join('-D' + macro + '\n' for macro in testentry['macros']))
 
-            if self.target_run:
-                make.add_phonytarget(sig_file + ' ' + disas_file)
-            else:
-                make.add_phonytarget(elf_file)
+    def _render_makefile(self, make, testList, name, cgf_file):
+        all_deps = []
+        dep_files = []
+        for file in testList:
+            block, goals, dep_file = self._render_test(testList[file], name, cgf_file)
+            make.add_block(block)
+            all_deps.extend(goals)
+            dep_files.append(dep_file)
+
+        make.add_final_target(all_deps)
+        make.add_include(dep_files)
 
+    def runTests(self, testList, cgf_file=None):
+        name = self.name[:-1]
+        makefile = os.path.join(self.work_dir, "Makefile." + name)
+        self._write_rsp_files(testList, name)
+        make = makeUtil(makefilePath=makefile)
+        make.makeCommand = self.make + ' ' + self.num_jobs_flag
+        self._render_makefile(make, testList, name, cgf_file)
+        make.flush()
         make.execute_all(self.work_dir)
@@ -1,5 +1,9 @@
+import collections
+import functools
+import io
 import logging
 import os
+import re
 import shutil
 
 import riscof.utils as utils
@@ -8,30 +12,111 @@ from riscof.pluginTemplate import pluginTemplate
 logger = logging.getLogger()
 
 
+@functools.lru_cache(maxsize=None)
+def _which(name):
+    return shutil.which(name)
+
+
+# Translate the 'jobs' config value into a make flag. 'auto' runs one job per
+# CPU, 'max' does not limit the number of jobs and any number is capped at
+# eight jobs per CPU so a typo cannot fork-bomb the host.
+def _jobs_flag(jobs):
+    ncpu = os.cpu_count() or 1
+    jobs = str(jobs).strip().lower()
+    if jobs == 'auto':
+        return '-j' + str(ncpu)
+    if jobs == 'max':
+        return '-j'
+    try:
+        return '-j' + str(max(1, min(int(jobs), 8 * ncpu)))
+    except ValueError:
+        logger.error("Invalid jobs value '" + jobs + "', expected a number, 'auto' or 'max'.")
+        raise SystemExit(1)
+
+
+_TestPaths = collections.namedtuple('_TestPaths', ['obj', 'dep', 'elf', 'disas', 'sig', 'rsp'])
+
+
+# riscof hands out POSIX work directories, so plain concatenation is enough
+def _paths(test_dir, name):
+    obj = test_dir + '/ref.o'
+    return _TestPaths(obj, obj + '.d', test_dir + '/ref.elf', test_dir + '/ref.disass',
+                      test_dir + '/' + name + '.signature', test_dir + '/defs.rsp')
+
+
+# Leave the file, and with it its timestamp, alone if it already has the wanted content
+def _write_if_changed(path, text):
+    if os.path.exists(path):
+        with open(path) as current:
+            if current.read() == text:
+                return
+    with open(path, "w") as new:
+        new.write(text)
+
+
+def _filetarget(command, output, input):
+    return "\n\n" + output + " : " + input + " \n\t" + command.replace("\n", "\n\t")
+
+
 class makeUtil(utils.makeUtil):
-    def add_filetarget(self, command, output, input):
-        with open(self.makefilePath, "a") as makefile:
-            makefile.write("\n\n" + output + " : " + input + " \n\t" + command.replace("\n", "\n\t"))
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Targets are collected in memory and written out in one go by flush()
+        self._buf = io.StringIO()
+        self._head = ""
+
+    def add_block(self, text):
+        self._buf.write(text)
 
-    def add_phonytarget(self, input, tname=""):
-        if tname == "":
-            tname = "TARGET" + str(len(self.targets))
-        with open(self.makefilePath, "a") as makefile:
-            makefile.write("\n\n.PHONY : " + tname + "\n" + tname + " : " + input + "\n")
-            self.targets.append(tname)
+    def add_include(self, paths):
+        # Optional include, so missing files (e.g. before the first build) are not an error
+        self._buf.write("\n\n-include " + " ".join(paths) + "\n")
+
+    def add_final_target(self, deps, tname="all"):
+        # Written ahead of all other rules by flush(), which also makes it the default goal
+        self._head = ".PHONY : " + tname + "\n" + tname + " : " + " ".join(deps) + "\n"
+        self.targets.append(tname)
+
+    def flush(self):
+        with open(self.makefilePath, "w") as makefile:
+            makefile.write(self._head + self._buf.getvalue())
 
 
 class spike(pluginTemplate):
     __model__ = "spike"
     __version__ = "XXX"
 
+    # ISA extensions in the order their suffixes are appended to self.isa
+    _EXT_TABLE = (
+        ("G", "IMAFDZicsr_Zifencei"),
+        ("I", "i"),
+        ("M", "m"),
+        ("F", "f"),
+        ("D", "d"),
+        ("C", "c"),
+        ("Zicsr", "_Zicsr"),
+        ("Zifencei", "_Zifencei"),
+        ("Zba", "_Zba"),
+        ("Zbb", "_Zbb"),
+        ("Zbc", "_Zbc"),
+        ("Zbkb", "_Zbkb"),
+        ("Zbkc", "_Zbkc"),
+        ("Zbkx", "_Zbkx"),
+        ("Zbs", "_Zbs"),
+        ("Zknd", "_Zknd"),
+        ("Zkne", "_Zkne"),
+        ("Zknh", "_Zknh"),
+        ("Zksed", "_Zksed"),
+        ("Zksh", "_Zksh"),
+    )
+
     def __init__(self, *args, **kwargs):
         sclass = super().__init__(*args, **kwargs)
 
         config = kwargs.get('config')
 
         self.ref_exe = os.path.join(config['PATH'] if 'PATH' in config else "", "spike")
-        self.num_jobs = str(config['jobs'] if 'jobs' in config else 1)
+        self.num_jobs_flag = _jobs_flag(config['jobs'] if 'jobs' in config else 1)
         self.pluginpath = os.path.abspath(config['pluginpath'])
         self.isa_spec = os.path.abspath(config['ispec']) if 'ispec' in config else ''
         self.platform_spec = os.path.abspath(config['pspec']) if 'ispec' in config else ''
@@ -43,6 +128,11 @@ class spike(pluginTemplate):
             self.target_run = False
         else:
             self.target_run = True
+        # The disassembly is only a debugging aid and can be skipped with disass=0
+        if 'disass' in config and config['disass'] == '0':
+            self.disass = False
+        else:
+            self.disass = True
         logger.debug("spike plugin initialised using the following configuration.")
         for entry in config:
             logger.debug(entry + ' : ' + config[entry])
@@ -50,19 +140,26 @@ class spike(pluginTemplate):
 
     def initialise(self, suite, work_dir, archtest_env):
         self.suite = suite
-        if shutil.which(self.ref_exe) is None:
+        if _which(self.ref_exe) is None:
             logger.error('Please install Executable for DUTNAME to proceed further')
             raise SystemExit(1)
         self.work_dir = work_dir
 
         # TODO: The following assumes you are using the riscv-gcc toolchain. If
         #      not please change appropriately
-        self.objdump_cmd = 'riscv{1}-unknown-elf-objdump -D {0} > {2};'
-        self.compile_cmd = 'riscv{1}-unknown-elf-gcc -march={0} \
-         -static -mcmodel=medany -fvisibility=hidden -nostdlib -nostartfiles\
-         -T ' + self.pluginpath + '/env/link.ld\
+        self.objdump_cmd = 'riscv{1}-unknown-elf-objdump -d {0} > {2};'
+        # Tests are compiled to an object file first and linked separately, so ccache (which does
+        # not cache link invocations) can serve the compile step
+        self.compile_cmd = 'riscv{1}-unknown-elf-gcc -c -march={0} \
+         -mcmodel=medany -fvisibility=hidden\
          -I ' + self.pluginpath + '/env/\
-         -I ' + archtest_env
+         -I ' + archtest_env + '\
+         -MMD -MP -MF {2}'
+        if _which('ccache') is not None:
+            self.compile_cmd = 'ccache ' + self.compile_cmd
+        self.link_cmd = 'riscv{1}-unknown-elf-gcc -march={0} \
+         -static -nostdlib -nostartfiles\
+         -T ' + self.pluginpath + '/env/link.ld'
 
         # set all the necessary variables like compile command, elf2hex
         # commands, objdump cmds. etc whichever you feel necessary and required
@@ -73,81 +170,76 @@ class spike(pluginTemplate):
         self.xlen = ('64' if 64 in ispec['supported_xlen'] else '32')
         # TODO: The following assumes you are using the riscv-gcc toolchain. If
         #      not please change appropriately
-        self.compile_cmd = self.compile_cmd + ' -mabi=' + ('lp64 ' if 64 in ispec['supported_xlen'] else 'ilp32 ')
-        self.isa = 'rv' + self.xlen
-        if "G" in ispec["ISA"]:
-            self.isa += "IMAFDZicsr_Zifencei"
-        if "I" in ispec["ISA"]:
-            self.isa += 'i'
-        if "M" in ispec["ISA"]:
-            self.isa += 'm'
-        if "F" in ispec["ISA"]:
-            self.isa += 'f'
-        if "D" in ispec["ISA"]:
-            self.isa += 'd'
-        if "C" in ispec["ISA"]:
-            self.isa += 'c'
-        if "Zicsr" in ispec["ISA"]:
-            self.isa += '_Zicsr'
-        if "Zifencei" in ispec["ISA"]:
-            self.isa += '_Zifencei'
-        if "Zba" in ispec["ISA"]:
-            self.isa += '_Zba'
-        if "Zbb" in ispec["ISA"]:
-            self.isa += '_Zbb'
-        if "Zbc" in ispec["ISA"]:
-            self.isa += '_Zbc'
-        if "Zbkb" in ispec["ISA"]:
-            self.isa += '_Zbkb'
-        if "Zbkc" in ispec["ISA"]:
-            self.isa += '_Zbkc'
-        if "Zbkx" in ispec["ISA"]:
-            self.isa += '_Zbkx'
-        if "Zbs" in ispec["ISA"]:
-            self.isa += '_Zbs'
-        if "Zknd" in ispec["ISA"]:
-            self.isa += '_Zknd'
-        if "Zkne" in ispec["ISA"]:
-            self.isa += '_Zkne'
-        if "Zknh" in ispec["ISA"]:
-            self.isa += '_Zknh'
-        if "Zksed" in ispec["ISA"]:
-            self.isa += '_Zksed'
-        if "Zksh" in ispec["ISA"]:
-            self.isa += '_Zksh'
+        mabi = ' -mabi=' + ('lp64 ' if 64 in ispec['supported_xlen'] else 'ilp32 ')
+        self.compile_cmd = self.compile_cmd + mabi
+        self.link_cmd = self.link_cmd + mabi
+        # xlen is fixed from here on, substitute it now and renumber the remaining per-test fields
+        self.compile_cmd = self.compile_cmd.format('{0}', self.xlen, '{1}')
+        self.link_cmd = self.link_cmd.format('{0}', self.xlen)
+        self.objdump_cmd = self.objdump_cmd.format('{0}', self.xlen, '{1}')
+        # Split e.g. RV64IMCZicsr_Zifencei into single-letter and Z extensions
+        isa_tokens = set(re.findall(r'Z[a-z]+|[A-Z]', ispec["ISA"]))
+        self.isa = ''.join(['rv', self.xlen] + [suffix for ext, suffix in self._EXT_TABLE if ext in isa_tokens])
 
         # based on the validated isa and platform configure your simulator or
         # build your RTL here
 
-    def runTests(self, testList, cgf_file=None):
-        if os.path.exists(self.work_dir + "/Makefile." + self.name[:-1]):
-            os.remove(self.work_dir + "/Makefile." + self.name[:-1])
-        make = makeUtil(makefilePath=os.path.join(self.work_dir, "Makefile." + self.name[:-1]))
-        make.makeCommand = self.make + ' -j' + self.num_jobs
+    # Render the Makefile rules of a single test. Only reads plugin state, so it can be
+    # called for any test independently of the others
+    def _render_test(self, testentry, name):
+        test = testentry['test_path']
+        test_dir = testentry['work_dir']
+
+        obj_file, dep_file, elf_file, disas_file, sig_file, rsp_file = _paths(test_dir, name)
+
+        isa = testentry['isa'].lower()
+        compile_cmd = ' '.join([self.compile_cmd.format(isa, dep_file), test, '-o', obj_file, '@' + rsp_file])
+        link_cmd = ' '.join([self.link_cmd.format(isa), obj_file, '-o', elf_file])
+
+        sim_cmd = self.ref_exe + ' --isa={0} +signature={1} +signature-granularity=4 {2}'.format(self.isa,
+                                                                                                    sig_file, elf_file)
+
+        rules = [_filetarget(compile_cmd, obj_file, test + ' ' + rsp_file),
+                 _filetarget(link_cmd, elf_file, obj_file)]
+        if self.target_run and self.disass:
+            disas_cmd = self.objdump_cmd.format(elf_file, disas_file)
+            rules.append(_filetarget(disas_cmd, disas_file, elf_file))
+        rules.append(_filetarget(sim_cmd, sig_file, elf_file))
+
+        goals = []
+        if self.target_run:
+            goals.append(sig_file)
+            if self.disass:
+                goals.append(disas_file)
+        else:
+            goals.append(elf_file)
+        return ''.join(rules), goals, dep_file
+
+    # The macros are handed to gcc in response files, which make can track like any other input
+    def _write_rsp_files(self, testList, name):
         for file in testList:
             testentry = testList[file]
-            test = testentry['test_path']
-            test_dir = testentry['work_dir']
+            rsp_file = _paths(testentry['work_dir'], name).rsp
+            _write_if_changed(rsp_file, ''.join('-D' + macro + '\n' for macro in testentry['macros']))
 
-            elf_file = os.path.join(test_dir, 'ref.elf')
-            disas_file = os.path.join(test_dir, 'ref.disass')
-
-            cmd = self.compile_cmd.format(testentry['isa'].lower(), self.xlen) + ' ' + test + ' -o ' + elf_file
-
-            compile_cmd = cmd + ' -D' + " -D".join(testentry['macros'])
-
-            disas_cmd = self.objdump_cmd.format(elf_file, self.xlen, disas_file)
-            sig_file = os.path.join(test_dir, self.name[:-1] + ".signature")
-
-            sim_cmd = self.ref_exe + ' --isa={0} +signature={1} +signature-granularity=4 {2}'.format(self.isa,
-                                                                                                        sig_file, elf_file)
+    def _render_makefile(self, make, testList, name):
+        all_deps = []
+        dep_files = []
+        for file in testList:
+            block, goals, dep_file = self._render_test(testList[file], name)
+            make.add_block(block)
+            all_deps.extend(goals)
+            dep_files.append(dep_file)
 
-            make.add_filetarget(compile_cmd, elf_file, test)
-            make.add_filetarget(disas_cmd, disas_file, elf_file)
-            make.add_filetarget(sim_cmd, sig_file, elf_file)
+        make.add_final_target(all_deps)
+        make.add_include(dep_files)
 
-            if self.target_run:
-                make.add_phonytarget(sig_file + ' ' + disas_file)
-            else:
-                make.add_phonytarget(os.path.join(test_dir, elf_file))
+    def runTests(self, testList, cgf_file=None):
+        name = self.name[:-1]
+        makefile = os.path.join(self.work_dir, "Makefile." + name)
+        self._write_rsp_files(testList, name)
+        make = makeUtil(makefilePath=makefile)
+        make.makeCommand = self.make + ' ' + self.num_jobs_flag
+        self._render_makefile(make, testList, name)
+        make.flush()
         make.execute_all(self.work_dir)